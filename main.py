@@ -1,8 +1,23 @@
 import os
+import io
 import json
+import hashlib
 import mimetypes
 import sys
 import re
+import threading
+import time
+import base64
+import codecs
+import gzip
+import atexit
+import cProfile
+import functools
+import pstats
+import traceback
+import tempfile
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -14,6 +29,10 @@ from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import markdown
 import argparse
 import bleach
+try:
+    from PIL import Image, ImageOps
+except ImportError: # Pillowが無ければ画像の縮小はしない
+    Image = ImageOps = None
 
 # APIキー設定
 load_dotenv()
@@ -26,13 +45,36 @@ genai.configure(api_key=api_key)
 parser = argparse.ArgumentParser()
 parser.add_argument("--prompt", type=str, help="デフォルトのシステムインストラクション")
 parser.add_argument("-d", action="store_true", help="起動時にダークテーマを有効にする")
+parser.add_argument("--model", type=str, default="gemini-2.5-flash", help="会話に使うモデル")
+parser.add_argument("--compare", type=str, nargs="+", metavar="MODEL[@KEY=VALUE,...]", help="比較モードで同時に問い合わせるモデルと生成設定 (例: gemini-2.5-pro gemini-2.5-flash@temperature=0.2)")
+parser.add_argument("--max-image-size", type=int, default=0, help="送信前に画像を縮小するときの長辺の最大ピクセル数（0なら縮小しない）")
+parser.add_argument("--image-format", choices=["webp", "jpeg"], default="webp", help="縮小した画像の再エンコード形式")
+parser.add_argument("--image-quality", type=int, default=85, help="再エンコード時の画質（1～100）")
+parser.add_argument("--watchdog", type=int, nargs="?", const=200, default=0, metavar="MS", help="GUIがMSミリ秒(省略時200)以上止まったら、そのときのスタックを出力する")
+parser.add_argument("--profile", type=str, nargs="?", const="gemini_chat.prof", metavar="FILE", help="主な処理をプロファイルして、終了時に結果を出力する")
+parser.add_argument("--benchmark", type=int, metavar="N", help="リセット直後と会話中の応答時間をN回ずつ計測して終了する")
+parser.add_argument("--upload-mbps", type=float, default=10.0, help="送信時間の短縮量を見積もるときの回線速度(Mbps)")
 args = parser.parse_args()
 instruction = ""
 if args.prompt: # デフォルトのシステムインストラクションを設定する
     instruction = args.prompt
 
+def parse_model_spec(spec):
+    # "モデル名@temperature=0.2,top_p=0.9" の形式を(表示名, モデル名, 生成設定)にする
+    model_name, _, settings = spec.partition("@")
+    generation_config = {}
+    for item in filter(None, settings.split(",")):
+        key, _, value = item.partition("=")
+        try:
+            generation_config[key.strip()] = float(value) if "." in value else int(value)
+        except ValueError:
+            parser.error(f"生成設定の値が数値ではありません: {item}")
+    return spec, model_name.strip(), generation_config or None
+
+compare_specs = [parse_model_spec(spec) for spec in args.compare or []] # 比較モードで使うモデル
+
 # モデル初期化
-def init_model(system_instruction="", history_param=None):
+def init_model(system_instruction="", history_param=None, model_name=None, generation_config=None):
     safety_settings = {
         HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
         HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
@@ -40,12 +82,788 @@ def init_model(system_instruction="", history_param=None):
         HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
     }
     model = genai.GenerativeModel(
-        model_name='gemini-2.5-flash', 
+        model_name=model_name or args.model, 
         system_instruction=system_instruction.strip() if system_instruction.strip() else None,
-        safety_settings=safety_settings
+        safety_settings=safety_settings,
+        generation_config=generation_config
     )
     return model.start_chat(history=history_param or [])
 
+# チャットセッションを作る係。genaiのクライアント（通信路）はモデルを作り直しても使い回されるが、
+# しばらく通信しないと接続が切れて次の送信が遅くなるので、ユーザーが入力している間に温め直す
+class SessionFactory:
+    WARM_INTERVAL = 60 # この秒数以上APIを使っていなければ、入力中に接続を温め直す
+
+    def __init__(self):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.model = None # 接続を温めるのに使うモデル（最後に作ったセッションのもの）
+        self.last_used = 0.0 # 最後に通信した時刻
+
+    def create(self, system_instruction="", history_param=None):
+        convo = init_model(system_instruction, history_param)
+        self.model = convo.model
+        return convo
+
+    def warm(self):
+        # ユーザーが入力している間に呼ぶ。接続が切れていそうなら温め直す（温めるときはそのFutureを返す）
+        if self.model is None or time.monotonic() - self.last_used < self.WARM_INTERVAL:
+            return None
+        self.last_used = time.monotonic() # 何度も呼ばれても1回だけにする
+        return self.pool.submit(self._warm, self.model)
+
+    def touch(self):
+        # APIと通信したときに呼ぶ
+        self.last_used = time.monotonic()
+
+    def _warm(self, model):
+        try:
+            model.count_tokens("ping") # 軽いリクエストで接続を確立しておく
+            self.touch()
+        except Exception: # 温めるのに失敗しても、本番の送信でやり直すだけなので無視する
+            pass
+
+def run_benchmark(rounds):
+    # しばらく放置したあとのリセット直後の1通目の応答時間が、会話を続けているときと変わらないかを計測する
+    idle_seconds = SessionFactory.WARM_INTERVAL + 5
+
+    def measure(convo):
+        start = time.perf_counter()
+        convo.send_message("「はい」とだけ答えてください。")
+        elapsed = time.perf_counter() - start
+        sessions.touch()
+        return elapsed
+
+    def summary(label, times):
+        times = sorted(times)
+        print(f"{label}: 平均 {sum(times) / len(times):.3f}秒, 中央値 {times[len(times) // 2]:.3f}秒")
+
+    print(f"放置した状態を作るため、1回あたり{idle_seconds * 2}秒ほど待ちます")
+    sessions = SessionFactory()
+    convo = sessions.create(instruction)
+    measure(convo) # 最初の接続のぶんは数えない
+
+    steady, cold, warmed = [], [], []
+    for i in range(rounds):
+        steady.append(measure(convo))
+
+        # 放置したあとリセットして、すぐに送信した場合（温めなし）
+        time.sleep(idle_seconds)
+        convo = sessions.create(instruction)
+        cold.append(measure(convo))
+
+        # 放置したあとリセットして、入力している間に接続を温め終わった場合
+        time.sleep(idle_seconds)
+        convo = sessions.create(instruction)
+        sessions.warm().result()
+        warmed.append(measure(convo))
+        print(f"{i + 1}/{rounds} 回目: 会話中 {steady[-1]:.3f}秒, リセット直後(温めなし) {cold[-1]:.3f}秒, リセット直後(温めあり) {warmed[-1]:.3f}秒")
+
+    summary("会話中", steady)
+    summary("リセット直後(温めなし)", cold)
+    summary("リセット直後(温めあり)", warmed)
+
+# 送信前のメディア前処理。ファイルの読み込みと画像の縮小はGUIスレッドを止めないようにスレッドプールで行う
+media_pool = ThreadPoolExecutor(max_workers=2)
+media_cache = {} # (内容のハッシュ, 設定) -> 処理結果。同じ画像を何度も送るときに縮小し直さないため（縮小しなかったものはNone）
+media_cache_lock = threading.Lock()
+MEDIA_CACHE_SIZE = 32
+
+def format_size(num_bytes):
+    # バイト数を読みやすい文字列にする
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+def shrink_image(file_bytes):
+    # 画像を長辺 --max-image-size 以下に縮小して再エンコードし、(データ, MIMEタイプ)を返す。小さくならなかったらNone
+    with Image.open(io.BytesIO(file_bytes)) as img:
+        if getattr(img, "is_animated", False): # アニメーションは1フレーム目だけになってしまうのでそのまま
+            return None
+        img.load()
+        img = ImageOps.exif_transpose(img) # 再エンコードでEXIFの向きの情報が消えるので、先に回転しておく
+        img.thumbnail((args.max_image_size, args.max_image_size)) # アスペクト比を保ったまま縮小（拡大はしない）
+
+        out = io.BytesIO()
+        if args.image_format == "jpeg":
+            img.convert("RGB").save(out, "JPEG", quality=args.image_quality, optimize=True)
+            new_mime = "image/jpeg"
+        else:
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            img.convert("RGBA" if has_alpha else "RGB").save(out, "WEBP", quality=args.image_quality)
+            new_mime = "image/webp"
+
+    data = out.getvalue()
+    if len(data) >= len(file_bytes):
+        return None
+    return data, new_mime
+
+def load_media(file_path, mime_type):
+    # ファイルを読み込んで、必要なら縮小する。戻り値は(送信するデータ, 元のサイズ)
+    with open(file_path, "rb") as f:
+        file_bytes = f.read()
+
+    # 画像以外（PDFなども）はそのまま送る
+    if Image is None or args.max_image_size <= 0 or not mime_type.startswith("image/"):
+        return {"mime_type": mime_type, "data": file_bytes}, len(file_bytes)
+
+    key = (hashlib.sha256(file_bytes).hexdigest(), args.max_image_size, args.image_format, args.image_quality)
+    with media_cache_lock:
+        hit = key in media_cache
+        cached = media_cache.get(key)
+    if not hit:
+        try:
+            cached = shrink_image(file_bytes)
+        except Exception: # Pillowで読めない画像はそのまま送る
+            cached = None
+        with media_cache_lock:
+            media_cache[key] = cached # 元のデータはキャッシュに持たない（大きな画像がずっと残ってしまう）
+            while len(media_cache) > MEDIA_CACHE_SIZE: # 古いものから捨てる
+                media_cache.pop(next(iter(media_cache)))
+
+    if cached is None: # 縮小しなかったので、読み込んだものをそのまま送る
+        return {"mime_type": mime_type, "data": file_bytes}, len(file_bytes)
+    data, new_mime = cached
+    return {"mime_type": new_mime, "data": data}, len(file_bytes)
+
+# HTML全体のテンプレート
+HTML_TEMPLATE = """
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <style>
+        {}
+    </style>
+    <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/{}.min.css">
+    <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css">
+    <script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"></script>
+    <script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"
+        onload="renderMathInElement(document.body, {{
+            delimiters: [
+                {{left: '$$', right: '$$', display: true}},
+                {{left: '$', right: '$', display: false}}
+            ],
+            throwOnError: false
+        }});">
+    </script>
+    <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"></script>
+    <script>hljs.highlightAll();</script>
+    <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
+    <script>
+        document.addEventListener("DOMContentLoaded", function() {{
+            new QWebChannel(qt.webChannelTransport, function(channel) {{
+                window.linkHandler = channel.objects.linkHandler;
+            }});
+        }});
+        // <a>タグのクリックをまとめて受け取る（後から差し込んだメッセージのリンクにも効くように）
+        document.addEventListener("click", function(e) {{
+            const link = e.target.closest("a");
+            const href = link && link.getAttribute("href");
+            if (href && href.startsWith("http") && window.linkHandler) {{
+                e.preventDefault(); // デフォルトのリンク遷移をやめる
+                linkHandler.link_click(href); // こっちで定義したリンククリック動作を呼び出し
+            }}
+        }});
+        // 読み込んだ会話の古いメッセージを、表示位置を保ったまま上に差し込む
+        function insertOlder(html) {{
+            const box = document.createElement("div");
+            box.innerHTML = html;
+            const oldHeight = document.body.scrollHeight;
+            const older = document.getElementById("older");
+            older.insertBefore(box, older.firstChild);
+            if (window.renderMathInElement) {{
+                renderMathInElement(box, {{
+                    delimiters: [
+                        {{left: '$$', right: '$$', display: true}},
+                        {{left: '$', right: '$', display: false}}
+                    ],
+                    throwOnError: false
+                }});
+            }}
+            box.querySelectorAll("pre code").forEach(function(el) {{ hljs.highlightElement(el); }});
+            window.scrollBy(0, document.body.scrollHeight - oldHeight);
+        }}
+    </script>
+</head>
+<body>
+    <div id="older"></div>
+    {}
+    <script>
+        setTimeout(function() {{
+            // HTML更新時に毎回スクロールがリセットされるのが鬱陶しいので一番下にスクロールするようにする。
+            window.scrollTo(0, document.body.scrollHeight);
+        }}, 100);
+    </script>
+</body>
+</html>
+"""
+
+# マークダウンを、表示できる安全なHTMLに変換する
+def render_markdown(text):
+    # 数式が壊れちゃうのでいろいろやる
+    # テキストから、$...$や$$...$$となっている箇所を取り出して、一時的に置き換え
+    math_blocks = []
+
+    # 数式おきかえ関数
+    def math_replacer(match):
+        math_blocks.append(match.group(0))
+        return f"@@MATH{len(math_blocks)-1}@@"
+
+    # もどす関数
+    def restore_math_expressions(text, blocks):
+        for i, expr in enumerate(blocks):
+            text = text.replace(f"@@MATH{i}@@", expr)
+        return text
+
+    # コードブロックとそれ以外のテキストに分割する
+    # re.splitのセパレータをキャプチャグループ `()` で囲むと、セパレータ自身も結果に含まれる。その結果、partsは次のようになる
+    # parts[0] = 最初のコードブロックの前の通常テキスト
+    # parts[1] = 最初のコードブロック全体
+    # parts[2] = 1番目と2番目のコードブロックの間の通常テキスト
+    parts = re.split(r"(```[\s\S]*?```)", text)
+
+    protected_parts = []
+    for i, part in enumerate(parts):
+        is_code_block = (i % 2 == 1)
+
+        if is_code_block:
+            # コードブロックは何も処理せず、そのまま追加
+            protected_parts.append(part)
+        else:
+            # コードブロックでない部分にのみ、数式保護処理を適用
+            temp_text = part
+            temp_text = re.sub(r"\$\$(.+?)\$\$", math_replacer, temp_text, flags=re.DOTALL) # $$...$$のパターン
+            temp_text = re.sub(r"(?<!\$)\$(.+?)\$(?!\$)", math_replacer, temp_text, flags=re.DOTALL) # $...$のパターン
+            protected_parts.append(temp_text)
+
+    # 全部くっつけちゃう
+    protected_markdown = "".join(protected_parts)
+
+    # マークダウンをHTMLに変換
+    html_content = markdown.markdown(
+        protected_markdown,
+        extensions=['fenced_code', 'tables', 'nl2br', 'toc', 'attr_list', 'def_list']
+    )
+
+    # 数式を戻す
+    html_content = restore_math_expressions(html_content, math_blocks)
+
+    # HTMLタグと属性のホワイトリスト
+    allowed_tags = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'strong', 'em', 'b', 'i', 'u', 's', 'strike', 'ul', 'ol', 'li', 'blockquote', 'pre', 'code', 'table', 'thead', 'tbody', 'tr', 'th', 'td', 'hr', 'br', 'span', 'a', 'img', 'details', 'summary']
+    allowed_attrs = {'*': ['class'], 'a': ['href', 'title'], 'span': ['class'], 'img': ['src']}
+
+    safe_html_content = bleach.clean(html_content, tags=allowed_tags, attributes=allowed_attrs) # bleachでエスケープする。これによってマークダウンの引用やコードブロック内の表示を崩さない
+    return safe_html_content
+
+# エクスポートしたHTMLに埋め込むライブラリ。オフラインでも数式とコードのハイライトが表示されるようにする
+KATEX_URL = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/"
+HIGHLIGHT_URL = "https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/"
+export_assets = {} # URL -> 中身。一度ダウンロードしたら使い回す
+
+def fetch_asset(url):
+    if url not in export_assets:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            export_assets[url] = response.read()
+    return export_assets[url]
+
+def inline_export_assets(highlight_theme):
+    # ライブラリをダウンロードして<style>/<script>に埋め込む形にする。取得できなければCDNを参照する形にする
+    try:
+        katex_css = fetch_asset(KATEX_URL + "katex.min.css").decode("utf-8")
+
+        # フォントはwoff2だけデータURIにして埋め込む（ほかの形式はwoff2が使えないときしか読まれないのでCDNのまま）
+        def font_replacer(match):
+            font = match.group(1)
+            if font.endswith(".woff2"):
+                data = base64.b64encode(fetch_asset(KATEX_URL + font)).decode("ascii")
+                return f"url(data:font/woff2;base64,{data})"
+            return f"url({KATEX_URL}{font})"
+        katex_css = re.sub(r"url\((fonts/[^)]+)\)", font_replacer, katex_css)
+
+        scripts = [
+            fetch_asset(KATEX_URL + "katex.min.js"),
+            fetch_asset(KATEX_URL + "contrib/auto-render.min.js"),
+            fetch_asset(HIGHLIGHT_URL + "highlight.min.js"),
+        ]
+        highlight_css = fetch_asset(f"{HIGHLIGHT_URL}styles/{highlight_theme}.min.css").decode("utf-8")
+    except Exception:
+        return (
+            f'<link rel="stylesheet" href="{HIGHLIGHT_URL}styles/{highlight_theme}.min.css">\n'
+            f'<link rel="stylesheet" href="{KATEX_URL}katex.min.css">',
+            f'<script src="{KATEX_URL}katex.min.js"></script>\n'
+            f'<script src="{KATEX_URL}contrib/auto-render.min.js"></script>\n'
+            f'<script src="{HIGHLIGHT_URL}highlight.min.js"></script>'
+        )
+
+    styles = f"<style>{highlight_css}</style>\n<style>{katex_css}</style>"
+    # スクリプトの中に</script>があるとそこでタグが閉じてしまうのでエスケープ
+    scripts = "\n".join("<script>" + js.decode("utf-8").replace("</script", "<\\/script") + "</script>" for js in scripts)
+    return styles, scripts
+
+# エクスポート用のHTMLのテンプレート。メッセージはこの間に1つずつ書き込む
+EXPORT_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <title>Gemini チャット</title>
+    <style>
+        {}
+    </style>
+    {}
+</head>
+<body>
+"""
+EXPORT_TAIL = """
+{}
+<script>
+    renderMathInElement(document.body, {{
+        delimiters: [
+            {{left: '$$', right: '$$', display: true}},
+            {{left: '$', right: '$', display: false}}
+        ],
+        throwOnError: false
+    }});
+    hljs.highlightAll();
+    window.exportReady = true;
+</script>
+</body>
+</html>
+"""
+
+RECENT_BLOCKS = 30 # 会話を読み込んだとき、すぐに表示する新しいメッセージの数
+
+# 描画済みHTMLのスナップショット。保存したファイルを読み込むときに、メッセージの描画をやり直さなくて済むようにする
+# ファイルの内容のハッシュごとにキャッシュディレクトリに保存する。描画結果はテーマによらない（テーマはCSSだけ）のでテーマは区別しない
+RENDERER_VERSION = 1 # render_markdownやChatBlockの出力を変えたら上げる（古いスナップショットは使われずに消える）
+RENDER_CACHE_LIMIT = 256 * 1024 * 1024 # キャッシュディレクトリの上限サイズ。超えたら使われていない順に消す
+snapshot_pool = ThreadPoolExecutor(max_workers=1) # スナップショットの書き込み用
+
+def hash_file(file_path):
+    content_hash = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            content_hash.update(chunk)
+    return content_hash.hexdigest()
+
+def snapshot_path(cache_dir, content_hash):
+    return os.path.join(cache_dir, f"{content_hash}.json.gz")
+
+def read_snapshot(cache_dir, content_hash, nodes):
+    # スナップショットがあれば、各ノードに描画済みのHTMLを入れる。nodesは行きがけ順のノードのリスト
+    # すべてのノードのHTMLがそろったときだけTrueを返す（表示していない分岐は描画されていないので、一部だけのこともある）
+    path = snapshot_path(cache_dir, content_hash)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return False
+    except Exception: # 壊れている
+        os.remove(path)
+        return False
+
+    fragments = data.get("fragments", [])
+    if data.get("version") != RENDERER_VERSION or len(fragments) != len(nodes): # 古い
+        os.remove(path)
+        return False
+
+    for node, html in zip(nodes, fragments):
+        if html is not None and node.block.html is None:
+            node.block.html = html
+    os.utime(path) # 最近使ったことにする（消す順番に使う）
+    return all(node.block.html is not None for node in nodes)
+
+def write_snapshot(cache_dir, content_hash, fragments):
+    # fragmentsは行きがけ順のノードごとの描画済みHTML（描画していないものはNone）
+    os.makedirs(cache_dir, exist_ok=True)
+    path = snapshot_path(cache_dir, content_hash)
+    with gzip.open(path + ".part", "wt", encoding="utf-8") as f:
+        json.dump({"version": RENDERER_VERSION, "fragments": fragments}, f, ensure_ascii=False)
+    os.replace(path + ".part", path)
+
+    # 上限を超えていたら、使われていない順に消す
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(".json.gz"):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cache_dir, name)))
+    total = sum(size for _, size, _ in entries)
+    for _, size, old_path in sorted(entries):
+        if total <= RENDER_CACHE_LIMIT:
+            break
+        if old_path != path:
+            os.remove(old_path)
+            total -= size
+
+def save_snapshot(cache_dir, file_path, fragments):
+    # 保存したファイルのスナップショットを作る（スレッドプールで実行する）
+    write_snapshot(cache_dir, hash_file(file_path), fragments)
+
+# 名前とクラス名を紐づけ
+SENDER_CLASS_MAP = {
+    "[あなた]": "user",
+    "[モデル]": "model",
+    "[システム]": "system",
+    "[エラー]": "error"
+}
+
+# 表示用の1メッセージ分。描画したHTMLをキャッシュしておき、表示の更新や分岐の切り替えのときに使い回す
+class ChatBlock:
+    __slots__ = ("sender", "text", "html")
+
+    def __init__(self, sender, text):
+        self.sender = sender
+        self.text = text
+        self.html = None
+
+    @property
+    def markdown(self):
+        sender_class = SENDER_CLASS_MAP.get(self.sender, "")
+        if self.sender == "[システム]":
+            return f"#### <span class='{sender_class}'>{self.sender[1:-1]}</span>\n\n*{self.text}*\n\n---\n\n"
+        elif self.sender == "[エラー]":
+            return f"#### <span class='{sender_class}'>{self.sender[1:-1]}</span>\n\n**{self.text}**\n\n---\n\n"
+        else:
+            return f"#### <span class='{sender_class}'>{self.sender[1:-1]}</span>\n\n{self.text}\n\n---\n\n"
+
+    def render(self):
+        if self.html is None:
+            self.html = render_markdown(self.markdown)
+        return self.html
+
+# 会話ツリーのノード。親をたどっていくと、そのノードまでの会話履歴になる
+class HistoryNode:
+    __slots__ = ("parent", "entry", "block", "content", "children")
+
+    def __init__(self, parent, entry, block):
+        self.parent = parent
+        self.entry = entry # 保存用の{'role': ..., 'parts': ...}（メディアはファイルパスになっている）
+        self.block = block # 表示用のChatBlock
+        self.content = None # 実際にAPIに送ったContent（メディアのデータを含む）。この起動中に送ったものだけ持っている
+        self.children = []
+
+# 会話履歴を木として持つ。メッセージを編集すると、そこから新しい分岐を作る
+# それより前の履歴はノードを共有するので、コピーは発生しない
+class ConversationTree:
+    def __init__(self):
+        self.root = HistoryNode(None, None, None)
+        self.current = self.root # いま表示している分岐の末尾
+
+    def append(self, entry, block):
+        node = HistoryNode(self.current, entry, block)
+        self.current.children.append(node)
+        self.current = node
+        return node
+
+    def path(self, node=None):
+        # ルートからnodeまでのノードのリスト（ルート自体は含まない）
+        node = node or self.current
+        nodes = []
+        while node is not self.root:
+            nodes.append(node)
+            node = node.parent
+        nodes.reverse()
+        return nodes
+
+    def history(self):
+        return [node.entry for node in self.path()]
+
+    def session_history(self, node=None):
+        # セッションを作り直すための履歴。送ったときのContentがあればそちらを使う
+        return [n.content if n.content is not None else n.entry for n in self.path(node)]
+
+    def can_restore(self, node=None):
+        # nodeまでのセッションを作り直せるか。読み込んだ会話のメディアはファイルパスしか残っていないので作り直せない
+        return all(n.content is not None or not isinstance(n.entry["parts"], list) for n in self.path(node))
+
+    def is_empty(self):
+        return not self.root.children
+
+    def nodes(self):
+        # 行きがけ順にすべてのノードを返す
+        stack = list(reversed(self.root.children))
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def leaves(self):
+        return [node for node in self.nodes() if not node.children]
+
+    def to_dict(self):
+        # 行きがけ順に並べて、親のインデックスで木を表す。親が直前のノードなら省略し、表示文がpartsと同じなら省略する
+        index = {self.root: -1}
+        nodes = []
+        for i, node in enumerate(self.nodes()):
+            index[node] = i
+            item = {"role": node.entry["role"], "parts": node.entry["parts"]}
+            if index[node.parent] != i - 1:
+                item["parent"] = index[node.parent]
+            if node.block.text != node.entry["parts"]:
+                item["text"] = node.block.text
+            nodes.append(item)
+        return {"nodes": nodes, "current": index[self.current]}
+
+    def add_item(self, nodes, item):
+        # to_dictの形式のノードを1つ追加する。nodesはここまでに追加したノードのリスト
+        parent_index = item.get("parent", len(nodes) - 1)
+        self.current = nodes[parent_index] if parent_index >= 0 else self.root
+        entry = {"role": item["role"], "parts": item["parts"]}
+        sender = "[あなた]" if item["role"] == "user" else "[モデル]"
+        nodes.append(self.append(entry, ChatBlock(sender, item.get("text", item["parts"]))))
+
+    def select(self, nodes, index):
+        self.current = nodes[index] if index >= 0 else self.root
+
+    def append_history_entry(self, entry):
+        # 以前の形式（一本道のhistory）の要素を1つ追加する
+        parts = entry.get("parts", "")
+        if entry.get("role") == "user":
+            if isinstance(parts, list):
+                text_parts = [p for p in parts if isinstance(p, str)]
+                media_parts = [p for p in parts if isinstance(p, dict)]
+                if media_parts:
+                    media = media_parts[0]
+                    text = f"**ファイル**: `{os.path.basename(media.get('data', ''))}` ({media.get('mime_type', '')})"
+                    if text_parts:
+                        text += f"\n\n**メッセージ**: {text_parts[0]}"
+                else:
+                    text = parts[0] if parts else ""
+            else:
+                text = parts
+            self.append(entry, ChatBlock("[あなた]", text))
+        elif entry.get("role") == "model":
+            self.append(entry, ChatBlock("[モデル]", parts))
+
+# 履歴からテキスト表示用のログを作る。読み込み中のスレッドからも使う
+def history_text(history):
+    lines = ["[システム] Geminiチャットへようこそ。\n" + "-"*30 + "\n\n"]
+    
+    for entry in history:
+        role = entry.get('role', '')
+        parts = entry.get('parts', '')
+        
+        if role == 'user':
+            if isinstance(parts, list):
+                # メディア付きメッセージの場合(そもそもメディア自体を保存していないので、この処理は不要かも（そのためメディアを添付した会話は再開不可能）)
+                text_parts = [p for p in parts if isinstance(p, str)]
+                media_parts = [p for p in parts if isinstance(p, dict)]
+                
+                if media_parts:
+                    file_info = f"**ファイル**: {media_parts[0].get('data', 'メディアファイル')}"
+                    if text_parts:
+                        file_info += f"\n\n**メッセージ**: {text_parts[0]}"
+                    lines.append(f"[あなた]\n{file_info}\n" + "="*50 + "\n\n")
+                else:
+                    lines.append(f"[あなた]\n{parts[0] if parts else ''}\n" + "="*50 + "\n\n")
+            else:
+                lines.append(f"[あなた]\n{parts}\n" + "="*50 + "\n\n")
+        elif role == 'model':
+            lines.append(f"[モデル]\n{parts}\n" + "="*50 + "\n\n")
+    return "".join(lines)
+
+# 大きなJSONファイルを、少しずつ読みながら解析する
+# オブジェクトのキーや配列の要素を1つずつ取り出せるので、ファイル全体を文字列として持たなくて済む
+class JsonStreamReader:
+    CHUNK_SIZE = 1 << 20
+    TAIL_MARGIN = 8 # 値の終わりからバッファの末尾までに、最低限ほしい文字数
+    STRING_SPECIAL = re.compile(r'["\\]') # 文字列の中で気にする文字
+    CONTAINER_SPECIAL = re.compile(r'["\[\]{}]') # 配列・オブジェクトの中で気にする文字
+
+    def __init__(self, f):
+        self.f = f # バイナリモードで開いたファイル
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytes_read = 0
+        self.content_hash = hashlib.sha256() # 読んだ内容のハッシュ（スナップショットの検索に使う）
+
+    def fill(self, size=0):
+        # 続きを読み込む。読んでいない部分が長いときはその分だけ読む（長い文字列でも読み直しが増えすぎないように）
+        data = self.f.read(max(size, self.CHUNK_SIZE))
+        self.bytes_read += len(data)
+        self.content_hash.update(data)
+        self.eof = not data
+        self.buffer = self.buffer[self.pos:] + self.decoder.decode(data, final=self.eof)
+        self.pos = 0
+        return not self.eof
+
+    def peek(self):
+        # 空白を飛ばして、次の文字を返す
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError("JSONが途中で終わっています")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"JSONの形式が正しくありません（'{char}'がありません）")
+        self.pos += 1
+
+    def value(self):
+        # 値を1つ読む。途中で切れていたら、続きを読んでやり直す
+        self.peek()
+        while True:
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+                # 数値は「1.」や「1.5e+」のように途中で切れていても手前までが読めてしまうので、
+                # バッファの末尾近くで終わった値は、続きを読んでから読み直す
+                if end + self.TAIL_MARGIN <= len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill(len(self.buffer) - self.pos)
+
+    def skip(self):
+        # 値を1つ読み飛ばす。文字列・配列・オブジェクトは解析せずに閉じるところを探すだけなので、
+        # 大きな値（以前の形式のchat_markdownなど）でも読み終えた部分はすぐに捨てられる
+        if self.peek() not in '"[{': # 数値などは短いので普通に読む
+            self.value()
+            return
+        depth = 0
+        in_string = False
+        escaped = False
+        while True:
+            if self.pos >= len(self.buffer):
+                if not self.fill():
+                    raise ValueError("JSONが途中で終わっています")
+                continue
+            if escaped: # バッファの末尾で切れたエスケープの続き
+                self.pos += 1
+                escaped = False
+                continue
+            match = (self.STRING_SPECIAL if in_string else self.CONTAINER_SPECIAL).search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                continue
+            self.pos = match.end()
+            char = match.group()
+            if char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = not in_string
+                if not in_string and depth == 0:
+                    return
+            elif char in "[{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _container(self, open_char, close_char, read_key):
+        self.expect(open_char)
+        if self.peek() == close_char:
+            self.pos += 1
+            return
+        while True:
+            if read_key:
+                key = self.value()
+                self.expect(":")
+                yield key
+            else:
+                yield None
+            char = self.peek()
+            self.pos += 1
+            if char == close_char:
+                return
+            if char != ",":
+                raise ValueError("JSONの形式が正しくありません")
+
+    def items(self):
+        # オブジェクトのキーを順に返す。値は呼び出し側がvalue()などで読むこと
+        return self._container("{", "}", True)
+
+    def elements(self):
+        # 配列の要素ごとに1回返す。要素は呼び出し側がvalue()などで読むこと
+        return self._container("[", "]", False)
+
+# --profile のときに、主な処理にかかった時間を測る
+class Profiler:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.sections = {} # 処理名 -> [呼び出し回数, 合計時間]
+        self.depth = 0 # 入れ子になった呼び出しの深さ（cProfileは一番外側でだけ有効にする）
+        if args.profile:
+            atexit.register(self.report)
+
+    def section(self, func):
+        # デコレータ。--profile がなければ何もしない
+        if not args.profile:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*func_args, **func_kwargs):
+            if self.depth == 0:
+                self.profile.enable()
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.depth -= 1
+                if self.depth == 0:
+                    self.profile.disable()
+                stat = self.sections.setdefault(func.__name__, [0, 0.0])
+                stat[0] += 1
+                stat[1] += elapsed
+        return wrapper
+
+    def report(self):
+        if not self.sections: # 一度も呼ばれていなければ出すものがない
+            return
+        print("\n[profile] 処理ごとの時間（入れ子の処理の時間も含む）", file=sys.stderr)
+        for name, (calls, total) in sorted(self.sections.items(), key=lambda item: -item[1][1]):
+            print(f"  {name:<16} {calls:>6}回  合計 {total:8.3f}秒  平均 {total / calls * 1000:8.1f}ms", file=sys.stderr)
+        self.profile.dump_stats(args.profile)
+        print(f"[profile] 関数ごとの詳細を {args.profile} に保存しました。上位の関数:", file=sys.stderr)
+        pstats.Stats(self.profile, stream=sys.stderr).sort_stats("cumulative").print_stats(20)
+
+profiler = Profiler()
+
+# GUIスレッドのイベントループが止まっていないかを見張る
+# GUIスレッドのタイマーが時刻を更新し、別スレッドがそれが止まっていないかを確認する
+class StallWatchdog:
+    INTERVAL = 0.05 # タイマーの間隔（秒）
+
+    def __init__(self, threshold_ms):
+        self.threshold = threshold_ms / 1000
+        self.main_thread_id = threading.get_ident() # GUIスレッドで作ること
+        self.last_tick = time.monotonic()
+        self.stalled = False
+
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.tick)
+        self.timer.start(int(self.INTERVAL * 1000))
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def tick(self):
+        now = time.monotonic()
+        if self.stalled: # 止まっていたのが動き出した
+            print(f"[watchdog] GUIスレッドが {(now - self.last_tick) * 1000:.0f}ms 止まっていました", file=sys.stderr)
+            self.stalled = False
+        self.last_tick = now
+
+    def watch(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            stalled_for = time.monotonic() - self.last_tick
+            if stalled_for > self.threshold and not self.stalled:
+                self.stalled = True
+                # 止まっている最中のGUIスレッドのスタックを取る
+                frame = sys._current_frames().get(self.main_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "(取得できませんでした)\n"
+                print(f"[watchdog] GUIスレッドが {stalled_for * 1000:.0f}ms 以上応答していません:\n{stack}", file=sys.stderr, end="")
+
 # テキストボックスのカーソルについて、一番上/一番下にカーソルがあるときに↑↓キーを押すとカーソルが一番手前/一番末尾に移動するようにクラスを作ってオーバーライド
 class CustomTextEdit(QTextEdit):
     def __init__(self, parent=None):
@@ -99,39 +917,247 @@ class ChatProcess(QThread):
     # シグナルの定義
     message_received = pyqtSignal(str) # メッセージ受信成功時
     error_occurred = pyqtSignal(str) # エラー発生時
+    media_reported = pyqtSignal(str) # メディアを縮小したときの報告
     
     def __init__(self, convo, message, media_data=None):
         super().__init__()
         self.convo = convo
         self.message = message
-        self.media_data = media_data
+        self.media_data = media_data # load_mediaのFutureを渡すこともできる
     
     def run(self):
         try:
-            if self.media_data: # メディアデータがあるか
-                self.convo.send_message([self.media_data, self.message])
+            report = None
+            if isinstance(self.media_data, Future): # 前処理の完了を待つ
+                media_data, original_size = self.media_data.result()
+                saved = original_size - len(media_data["data"])
+                if saved > 0:
+                    report = (original_size, len(media_data["data"]), saved)
+            else:
+                media_data = self.media_data
+
+            start = time.perf_counter()
+            if media_data: # メディアデータがあるか
+                self.convo.send_message([media_data, self.message])
             else:
                 self.convo.send_message(self.message)
+            elapsed = time.perf_counter() - start
             # 返信を取得
             reply = self.convo.last.text
+
+            if report: # どれくらい小さくなったかを報告する
+                original_size, sent_size, saved = report
+                saved_sec = saved * 8 / (args.upload_mbps * 1_000_000)
+                self.media_reported.emit(
+                    f"画像を縮小して送信しました: {format_size(original_size)} → {format_size(sent_size)} "
+                    f"({saved / original_size:.0%}削減, 送信時間 約{saved_sec:.1f}秒短縮の見込み, 応答まで{elapsed:.1f}秒)"
+                )
             # シグナルを発行
             self.message_received.emit(reply)
         except Exception as e:
             # 失敗したらしたでエラーのシグナルを発行
             self.error_occurred.emit(f"{type(e).__name__} - {e}")
 
+# 比較モード用のクラス。同じメッセージを、いまの会話と比較用のモデルに同時に送る
+class CompareProcess(QThread):
+    compare_received = pyqtSignal(list) # モデルごとの結果のリスト（先頭がいまの会話）
+    error_occurred = pyqtSignal(str)
+    # 最後まで返答できたときの終了理由。ストリーミングだとそれ以外（RECITATIONやSAFETYなど）でもエラーにならないので自分で確かめる
+    FINISHED = (genai.protos.Candidate.FinishReason.STOP, genai.protos.Candidate.FinishReason.MAX_TOKENS)
+
+    def __init__(self, convo, system_instruction, history, message):
+        super().__init__()
+        self.convo = convo
+        self.system_instruction = system_instruction
+        self.history = history # 比較用のモデルにも同じ履歴を渡す
+        self.message = message
+
+    def ask(self, label, convo):
+        # ストリーミングで受け取って、最初の応答までの時間(TTFT)と全体の時間を測る
+        result = {"label": label}
+        response = None
+        try:
+            start = time.perf_counter()
+            response = convo.send_message(self.message, stream=True)
+            for chunk in response:
+                if "ttft" not in result:
+                    result["ttft"] = time.perf_counter() - start
+            result["total"] = time.perf_counter() - start
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            if finish_reason not in self.FINISHED:
+                raise ValueError(f"返答が途中で終わりました（{getattr(finish_reason, 'name', finish_reason)}）")
+            result["reply"] = response.text
+            usage = response.usage_metadata
+            result["prompt_tokens"] = getattr(usage, "prompt_token_count", 0)
+            result["output_tokens"] = getattr(usage, "candidates_token_count", 0)
+        except Exception as e:
+            result["error"] = f"{type(e).__name__} - {e}"
+            if response is not None:
+                # 途中で失敗した返答がセッションに残っていると、以後historyを読むたびにBrokenResponseErrorになるので取り消す
+                # （send_message自体が失敗したときは何も残っていないので、取り消すと前の往復が消えてしまう）
+                convo.rewind()
+        return result
+
+    def ask_new(self, label, model_name, generation_config):
+        # 比較用のモデルは同じ履歴から作る。作れなかったときもそのモデルの結果がエラーになるだけにする
+        try:
+            convo = init_model(self.system_instruction, self.history, model_name, generation_config)
+        except Exception as e:
+            return {"label": label, "error": f"{type(e).__name__} - {e}"}
+        return self.ask(label, convo)
+
+    def run(self):
+        try:
+            with ThreadPoolExecutor(max_workers=len(compare_specs) + 1) as pool:
+                futures = [pool.submit(self.ask, args.model, self.convo)]
+                for spec in compare_specs:
+                    futures.append(pool.submit(self.ask_new, *spec))
+                results = [future.result() for future in futures]
+            self.compare_received.emit(results)
+        except Exception as e:
+            self.error_occurred.emit(f"{type(e).__name__} - {e}")
+
+# 読み込み用のクラス。保存したファイルを少しずつ解析して、会話ツリーとテキスト表示用のログを作る
+class LoadProcess(QThread):
+    progress = pyqtSignal(int) # 読み込んだ割合(%)
+    loaded = pyqtSignal(object, object, str, str, str, bool) # (会話ツリー, セッション, システムインストラクション, テキスト表示用のログ, ファイルのハッシュ, スナップショットで全部そろったか)
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, file_path, cache_dir):
+        super().__init__()
+        self.file_path = file_path
+        self.cache_dir = cache_dir # 描画済みHTMLのスナップショットの場所
+        self.percent = -1
+
+    def report_progress(self, reader):
+        percent = reader.bytes_read * 100 // max(self.file_size, 1)
+        if percent != self.percent:
+            self.percent = percent
+            self.progress.emit(percent)
+
+    def run(self):
+        try:
+            self.file_size = os.path.getsize(self.file_path)
+            tree = ConversationTree()
+            nodes = []
+            current = None
+            system_instruction = ""
+            with open(self.file_path, "rb") as f:
+                reader = JsonStreamReader(f)
+                for key in reader.items():
+                    if key == "tree":
+                        for tree_key in reader.items():
+                            if tree_key == "nodes":
+                                for _ in reader.elements():
+                                    tree.add_item(nodes, reader.value())
+                                    self.report_progress(reader)
+                            elif tree_key == "current":
+                                current = reader.value()
+                            else:
+                                reader.skip()
+                    elif key == "history": # 分岐がなかったころの形式
+                        for _ in reader.elements():
+                            tree.append_history_entry(reader.value())
+                            self.report_progress(reader)
+                    elif key == "system_instruction":
+                        system_instruction = reader.value()
+                    else: # 使わない値（以前の形式のchat_markdownなど）は解析せずに読み飛ばす
+                        reader.skip()
+            if current is not None:
+                tree.select(nodes, current)
+
+            content_hash = reader.content_hash.hexdigest()
+            try:
+                snapshot_hit = read_snapshot(self.cache_dir, content_hash, list(tree.nodes())) # 一部だけならFalse
+            except Exception: # キャッシュが使えなくても、描画し直すだけ
+                snapshot_hit = False
+            # モデルは、表示する分岐の履歴だけで作り直す。履歴が長いと時間がかかるので、ここで作っておく
+            convo = init_model(system_instruction, tree.history())
+            self.loaded.emit(tree, convo, system_instruction, history_text(tree.history()), content_hash, snapshot_hit)
+        except Exception as e:
+            self.error_occurred.emit(f"{type(e).__name__} - {e}")
+
+# 読み込んだ会話の古いメッセージを、新しいほうから順にバックグラウンドで描画する
+class RenderProcess(QThread):
+    batch_rendered = pyqtSignal(int) # このインデックスから後ろは描画済み
+    BATCH_SIZE = 50
+
+    def __init__(self, blocks, parent=None):
+        super().__init__(parent) # 途中でやめても、終わるまでは親が持っておく
+        self.blocks = blocks
+        self.cancelled = False
+
+    def run(self):
+        end = len(self.blocks)
+        while end > 0 and not self.cancelled:
+            start = max(0, end - self.BATCH_SIZE)
+            for block in self.blocks[start:end]:
+                block.render() # 描画結果はブロックにキャッシュされる
+            self.batch_rendered.emit(start)
+            end = start
+
+# エクスポート用のクラス。メッセージを1つずつファイルに書き出すので、長い会話でも文書全体をメモリに持たない
+class ExportProcess(QThread):
+    progress = pyqtSignal(int, int) # (書き出したメッセージ数, 全体の数)
+    export_finished = pyqtSignal(str) # 書き出したファイルのパス
+    error_occurred = pyqtSignal(str)
+
+    def __init__(self, blocks, file_path, export_format, theme_styles, highlight_theme, parent=None):
+        super().__init__(parent) # 完了のシグナルを受けて参照を手放しても、スレッドが終わるまでは親が持っておく
+        self.blocks = list(blocks) # 書き出し中に会話が進んでもいいように、その時点のリストを取っておく
+        self.file_path = file_path
+        self.export_format = export_format # "html" か "md"
+        self.theme_styles = theme_styles
+        self.highlight_theme = highlight_theme
+
+    def run(self):
+        temp_path = self.file_path + ".part" # 途中で失敗しても元のファイルを壊さない
+        try:
+            total = len(self.blocks)
+            with open(temp_path, "w", encoding="utf-8") as f:
+                if self.export_format == "md":
+                    for i, block in enumerate(self.blocks):
+                        f.write(block.markdown)
+                        if i % 100 == 0:
+                            self.progress.emit(i, total)
+                else:
+                    styles, scripts = inline_export_assets(self.highlight_theme)
+                    f.write(EXPORT_HEAD.format(self.theme_styles, styles))
+                    for i, block in enumerate(self.blocks):
+                        f.write(block.render())
+                        if i % 100 == 0:
+                            self.progress.emit(i, total)
+                    f.write(EXPORT_TAIL.format(scripts))
+            os.replace(temp_path, self.file_path)
+            self.export_finished.emit(self.file_path)
+        except Exception as e:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.error_occurred.emit(f"{type(e).__name__} - {e}")
+
 # 本体
 class GeminiChatApp(QMainWindow):
     def __init__(self):
         super().__init__()
         self.system_instruction = instruction # システムインストラクション
-        self.convo = init_model(self.system_instruction) # チャット
-        self.history = [] # 会話履歴
+        self.sessions = SessionFactory() # チャットセッションの作成係
+        self.convo = self.sessions.create(self.system_instruction) # チャット
+        self.tree = ConversationTree() # 会話履歴（分岐を含む木）
         self.model_name = "モデル" # モデル名
-        self.chat_markdown = "" # マークダウンのチャットログ
+        self.chat_blocks = [] # 表示しているメッセージのリスト
+        self.pending_block = None # 返答待ちのユーザーメッセージの表示
         self.current_worker = None # 非同期処理中のスレッド
         self.is_processing = False # APIの返答待ちかどうかのフラグ
         self.is_dark_theme = args.d # オプションによってテーマを変更する
+        self.export_worker = None # エクスポート中のスレッド
+        self.pdf_page = None # PDFを書き出すためのページ
+        self.load_worker = None # 読み込み中のスレッド
+        self.render_worker = None # 古いメッセージを描画中のスレッド
+        self.hidden_blocks = 0 # chat_blocksの先頭のうち、まだ描画が終わっていないメッセージの数
+        self.shown_from = 0 # HTML表示に入っている最初のメッセージのインデックス
+        self.page_loading = False # HTML表示の読み込み中かどうか
+        self.render_cache_dir = os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "render") # スナップショットの場所
+        self.pending_snapshot = None # 描画が終わったら書き込むスナップショット(ファイルのハッシュ, ノードのリスト, 読み込んだ時点で描画されていなかった数)
         
         self.init_ui() # UIの初期化
         self.setup_theme_palettes() # ダークテーマのパレットの設定
@@ -213,6 +1239,7 @@ class GeminiChatApp(QMainWindow):
         self.chat_html_view.setAcceptDrops(True) # ドラッグアンドドロップを有効化しておく
         self.chat_html_view.dragEnterEvent = self.drag_enter_event
         self.chat_html_view.dropEvent = self.drop_event
+        self.chat_html_view.loadFinished.connect(self.page_loaded)
         self.chat_tabs.addTab(self.chat_html_view, "HTML表示")
         
         # テキスト
@@ -240,6 +1267,7 @@ class GeminiChatApp(QMainWindow):
         self.user_input.setPlaceholderText("メッセージを入力してください... (Ctrl+Enter で送信)")
         self.user_input.setAcceptRichText(False)
         self.user_input.keyPressEvent = self.key_press # キー入力を差し替え（Ctrl+Enterで送信する処理。key_press内でもkeyPressEventを呼んでいるしkeyPressEventは別の場所でオーバーライドしているしもうめちゃくちゃ）
+        self.user_input.textChanged.connect(lambda: self.sessions.warm()) # 入力中に接続を温めておく
         input_row.addWidget(self.user_input)
 
         self.send_btn = QPushButton("送信\n(Ctrl+Enter)")
@@ -264,6 +1292,21 @@ class GeminiChatApp(QMainWindow):
         self.save_btn.setMaximumWidth(60)
         btn_layout.addWidget(self.save_btn)
 
+        self.export_btn = QPushButton("エクスポート")
+        self.export_btn.clicked.connect(self.export_chat)
+        self.export_btn.setMaximumWidth(90)
+        btn_layout.addWidget(self.export_btn)
+
+        self.edit_btn = QPushButton("編集")
+        self.edit_btn.clicked.connect(self.edit_message)
+        self.edit_btn.setMaximumWidth(60)
+        btn_layout.addWidget(self.edit_btn)
+
+        self.branch_btn = QPushButton("分岐切替")
+        self.branch_btn.clicked.connect(self.switch_branch)
+        self.branch_btn.setMaximumWidth(80)
+        btn_layout.addWidget(self.branch_btn)
+
         self.load_btn = QPushButton("読み込み")
         self.load_btn.clicked.connect(self.load_chat)
         self.load_btn.setMaximumWidth(80)
@@ -276,6 +1319,11 @@ class GeminiChatApp(QMainWindow):
 
         btn_layout.addStretch()# ボタンを中央に寄せるためのスペーサー
 
+        self.compare_checkbox = QCheckBox("比較モード")
+        self.compare_checkbox.setToolTip("--compare で指定したモデルにも同時に送信して、返答を並べて表示します")
+        self.compare_checkbox.setVisible(bool(compare_specs)) # 比較するモデルが指定されているときだけ
+        btn_layout.addWidget(self.compare_checkbox)
+
         self.dark_theme_checkbox = QCheckBox("ダークテーマ")
         self.dark_theme_checkbox.setChecked(self.is_dark_theme)
         self.dark_theme_checkbox.stateChanged.connect(self.toggle_theme)
@@ -326,6 +1374,9 @@ class GeminiChatApp(QMainWindow):
             table { border-collapse: collapse; width: 100%; margin: 10px 0; }
             th, td { border: 1px solid #ddd; padding: 8px; text-align: left; }
             th { background-color: #f2f2f2; font-weight: bold; }
+            table.compare { table-layout: fixed; }
+            table.compare td { vertical-align: top; }
+            .metrics { color: #666666; font-size: 0.9em; }
             ul, ol { margin: 10px 0; padding-left: 20px; }
             li { margin: 5px 0; }
             p { margin: 10px 0; }
@@ -357,6 +1408,9 @@ class GeminiChatApp(QMainWindow):
             table { border-collapse: collapse; width: 100%; margin: 10px 0; }
             th, td { border: 1px solid #555; padding: 8px; text-align: left; }
             th { background-color: #404040; font-weight: bold; }
+            table.compare { table-layout: fixed; }
+            table.compare td { vertical-align: top; }
+            .metrics { color: #cccccc; font-size: 0.9em; }
             ul, ol { margin: 10px 0; padding-left: 20px; }
             li { margin: 5px 0; }
             p { margin: 10px 0; }
@@ -379,7 +1433,7 @@ class GeminiChatApp(QMainWindow):
     def set_input_enabled(self, enabled):
         # 入力の可否を切り替える
         # 対象となるウィジェット群
-        widgets = [self.user_input, self.send_btn, self.media_btn, self.apply_btn, self.sys_inst_entry]
+        widgets = [self.user_input, self.send_btn, self.media_btn, self.apply_btn, self.sys_inst_entry, self.edit_btn, self.branch_btn]
         for widget in widgets:
             widget.setEnabled(enabled) # 触れるかを切り替える
         
@@ -415,135 +1469,80 @@ class GeminiChatApp(QMainWindow):
         if not self.is_processing: # 処理中でないとき
             instruction = self.sys_inst_entry.toPlainText().strip()
             self.system_instruction = instruction
+            self.stop_progressive()
             # 新しいインストラクションでモデルを初期化
-            self.convo = init_model(self.system_instruction)
+            self.convo = self.sessions.create(self.system_instruction)
             # もろもろリセット
-            self.history.clear()
-            self.chat_markdown = ""
+            self.tree = ConversationTree()
+            self.chat_blocks = []
             self.chat_text_content = ""
             self.add_message("[システム]", "システムインストラクションを更新し、会話をリセットしました。")
             # 入力欄にカーソルを移動
             self.user_input.setFocus()
     
-    def update_chat(self):   
-        # HTML全体のテンプレート     
-        html_template = """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8">
-            <style>
-                {}
-            </style>
-            <link rel="stylesheet" href="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/styles/{}.min.css">
-            <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.css">
-            <script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/katex.min.js"></script>
-            <script defer src="https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/contrib/auto-render.min.js"
-                onload="renderMathInElement(document.body, {{
-                    delimiters: [
-                        {{left: '$$', right: '$$', display: true}},
-                        {{left: '$', right: '$', display: false}}
-                    ],
-                    throwOnError: false
-                }});">
-            </script>
-            <script src="https://cdnjs.cloudflare.com/ajax/libs/highlight.js/11.9.0/highlight.min.js"></script>
-            <script>hljs.highlightAll();</script>
-            <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
-            <script>
-                document.addEventListener("DOMContentLoaded", function() {{
-                    new QWebChannel(qt.webChannelTransport, function(channel) {{
-                        window.linkHandler = channel.objects.linkHandler;
-                        // <a>タグに対してクリック時のイベントを設定
-                        document.querySelectorAll("a").forEach(function(link) {{
-                            const href = link.getAttribute("href");
-                            if (href && href.startsWith("http")) {{
-                                link.onclick = function(e) {{
-                                    e.preventDefault(); // デフォルトのリンク遷移をやめる
-                                    linkHandler.link_click(href); // こっちで定義したリンククリック動作を呼び出し
-                                }};
-                            }}
-                        }});
-                    }});
-                }});
-            </script>
-        </head>
-        <body>
-            {}
-            <script>
-                setTimeout(function() {{
-                    // HTML更新時に毎回スクロールがリセットされるのが鬱陶しいので一番下にスクロールするようにする。
-                    window.scrollTo(0, document.body.scrollHeight);
-                }}, 100);
-            </script>
-        </body>
-        </html>
-        """
-    
-        # 数式が壊れちゃうのでいろいろやる
-        # テキストから、$...$や$$...$$となっている箇所を取り出して、一時的に置き換え
-        math_blocks = []
-
-        # 数式おきかえ関数
-        def math_replacer(match):
-            math_blocks.append(match.group(0))
-            return f"@@MATH{len(math_blocks)-1}@@"
-
-        # もどす関数
-        def restore_math_expressions(text, blocks):
-            for i, expr in enumerate(blocks):
-                text = text.replace(f"@@MATH{i}@@", expr)
-            return text
-
-        # コードブロックとそれ以外のテキストに分割する
-        # re.splitのセパレータをキャプチャグループ `()` で囲むと、セパレータ自身も結果に含まれる。その結果、partsは次のようになる
-        # parts[0] = 最初のコードブロックの前の通常テキスト
-        # parts[1] = 最初のコードブロック全体
-        # parts[2] = 1番目と2番目のコードブロックの間の通常テキスト
-        parts = re.split(r"(```[\s\S]*?```)", self.chat_markdown)
-
-        protected_parts = []
-        for i, part in enumerate(parts):
-            is_code_block = (i % 2 == 1)
-
-            if is_code_block:
-                # コードブロックは何も処理せず、そのまま追加
-                protected_parts.append(part)
-            else:
-                # コードブロックでない部分にのみ、数式保護処理を適用
-                temp_text = part
-                temp_text = re.sub(r"\$\$(.+?)\$\$", math_replacer, temp_text, flags=re.DOTALL) # $$...$$のパターン
-                temp_text = re.sub(r"(?<!\$)\$(.+?)\$(?!\$)", math_replacer, temp_text, flags=re.DOTALL) # $...$のパターン
-                protected_parts.append(temp_text)
-
-        # 全部くっつけちゃう
-        protected_markdown = "".join(protected_parts)
-
-        # マークダウンをHTMLに変換
-        html_content = markdown.markdown(
-            protected_markdown,
-            extensions=['fenced_code', 'tables', 'nl2br', 'toc', 'attr_list', 'def_list']
-        )
-
-        # 数式を戻す
-        html_content = restore_math_expressions(html_content, math_blocks)
-
-        # HTMLタグと属性のホワイトリスト
-        allowed_tags = ['p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'strong', 'em', 'b', 'i', 'u', 's', 'strike', 'ul', 'ol', 'li', 'blockquote', 'pre', 'code', 'table', 'thead', 'tbody', 'tr', 'th', 'td', 'hr', 'br', 'span', 'a', 'img', 'details', 'summary']
-        allowed_attrs = {'*': ['class'], 'a': ['href', 'title'], 'span': ['class'], 'img': ['src']}
-
-        safe_html_content = bleach.clean(html_content, tags=allowed_tags, attributes=allowed_attrs) # bleachでエスケープする。これによってマークダウンの引用やコードブロック内の表示を崩さない
+    @profiler.section
+    def update_chat(self):
+        # メッセージごとに描画したHTMLはキャッシュされているので、つなげるだけ
+        # 読み込んだ会話の古いメッセージは、描画が終わったものから page_loaded/older_rendered で差し込む
+        safe_html_content = "".join(block.render() for block in self.chat_blocks[self.hidden_blocks:])
+        self.shown_from = self.hidden_blocks
 
         # 現在のテーマに合わせたスタイルを取得
         theme_styles = self.get_html_theme_styles()
         highlight_theme = "atom-one-dark" if self.is_dark_theme else "atom-one-light"
         
-        final_html = html_template.format(theme_styles, highlight_theme, safe_html_content)
+        final_html = HTML_TEMPLATE.format(theme_styles, highlight_theme, safe_html_content)
+        self.page_loading = True
         self.chat_html_view.setHtml(final_html)
     
+    def page_loaded(self, ok):
+        self.page_loading = False
+        self.insert_older()
+    
+    def older_rendered(self, start):
+        if self.sender() is not self.render_worker: # 前に読み込んだ会話のもの
+            return
+        self.hidden_blocks = start
+        if start == 0:
+            self.render_worker = None
+            self.statusBar().clearMessage()
+            self.store_snapshot()
+        self.insert_older()
+    
+    def insert_older(self):
+        # 描画が終わった古いメッセージを、HTML表示の上に差し込む
+        if self.page_loading or self.hidden_blocks >= self.shown_from:
+            return
+        html = "".join(block.html for block in self.chat_blocks[self.hidden_blocks:self.shown_from])
+        self.shown_from = self.hidden_blocks
+        self.chat_html_view.page().runJavaScript(f"insertOlder({json.dumps(html)});")
+    
+    def stop_progressive(self):
+        # 古いメッセージの描画を途中でやめる（表示する会話を入れ替えるとき）
+        if self.render_worker is not None:
+            self.render_worker.cancelled = True
+            self.render_worker = None
+            self.statusBar().clearMessage()
+        self.hidden_blocks = 0
+        self.pending_snapshot = None
+    
+    def store_snapshot(self):
+        # 読み込んだ会話の描画が終わったら、次に開くときのためにスナップショットを書き込む
+        if self.pending_snapshot is None:
+            return
+        content_hash, nodes, missing = self.pending_snapshot
+        self.pending_snapshot = None
+        fragments = [node.block.html for node in nodes]
+        if fragments.count(None) >= missing: # 読み込んだスナップショットから増えていなければ書き直さない
+            return
+        snapshot_pool.submit(write_snapshot, self.render_cache_dir, content_hash, fragments)
+    
+    @profiler.section
     def update_text(self):
         if not hasattr(self, 'chat_text_content'):
             self.chat_text_content = ""
+        if self.chat_tabs.currentIndex() != 1: # 見えていないときは、タブを切り替えたときに更新する
+            return
         
         self.chat_text_view.setPlainText(self.chat_text_content)
         # カーソルを一番下へ
@@ -551,56 +1550,23 @@ class GeminiChatApp(QMainWindow):
         cursor.movePosition(cursor.End)
         self.chat_text_view.setTextCursor(cursor)
     
+    @profiler.section
     def regenerate(self):
         # 履歴からテキスト表示を再生成
-        self.chat_text_content = ""
-        self.chat_text_content += "[システム] Geminiチャットへようこそ。\n" + "-"*30 + "\n\n"
-        
-        for entry in self.history:
-            role = entry.get('role', '')
-            parts = entry.get('parts', '')
-            
-            if role == 'user':
-                if isinstance(parts, list):
-                    # メディア付きメッセージの場合(そもそもメディア自体を保存していないので、この処理は不要かも（そのためメディアを添付した会話は再開不可能）)
-                    text_parts = [p for p in parts if isinstance(p, str)]
-                    media_parts = [p for p in parts if isinstance(p, dict)]
-                    
-                    if media_parts:
-                        file_info = f"**ファイル**: {media_parts[0].get('data', 'メディアファイル')}"
-                        if text_parts:
-                            file_info += f"\n\n**メッセージ**: {text_parts[0]}"
-                        self.chat_text_content += f"[あなた]\n{file_info}\n" + "="*50 + "\n\n"
-                    else:
-                        self.chat_text_content += f"[あなた]\n{parts[0] if parts else ''}\n" + "="*50 + "\n\n"
-                else:
-                    self.chat_text_content += f"[あなた]\n{parts}\n" + "="*50 + "\n\n"
-            elif role == 'model':
-                self.chat_text_content += f"[モデル]\n{parts}\n" + "="*50 + "\n\n"
-
-    def add_message(self, sender, text):
-        # 新しいメッセージをログに記録して表示を更新する
-        # マークダウンに追加
-        # 名前とクラス名を紐づけ
-        sender_class_map = {
-            "[あなた]": "user",
-            "[モデル]": "model",
-            "[システム]": "system",
-            "[エラー]": "error"
-        }
-        sender_class = sender_class_map.get(sender, "")
-
-        if sender == "[システム]":
-             self.chat_markdown += f"#### <span class='{sender_class}'>{sender[1:-1]}</span>\n\n*{text}*\n\n---\n\n"
-        elif sender == "[エラー]":
-             self.chat_markdown += f"#### <span class='{sender_class}'>{sender[1:-1]}</span>\n\n**{text}**\n\n---\n\n"
-        else:
-             self.chat_markdown += f"#### <span class='{sender_class}'>{sender[1:-1]}</span>\n\n{text}\n\n---\n\n"
+        self.chat_text_content = history_text(self.tree.history())
+
+    @profiler.section
+    def add_message(self, sender, text, plain_text=None):
+        # 新しいメッセージをログに記録して表示を更新する。会話ツリーに登録できるように、追加した表示を返す
+        # textがHTMLのときは、テキスト表示用の文をplain_textで渡す
+        block = ChatBlock(sender, text)
+        self.chat_blocks.append(block)
 
         # テキストに追加
         if not hasattr(self, 'chat_text_content'):
             self.chat_text_content = ""
         
+        text = plain_text if plain_text is not None else text
         if sender in ["[あなた]", "[モデル]"]:
             self.chat_text_content += f"{sender}\n{text}\n" + "="*30 + "\n\n"
         else: # システムとエラー
@@ -609,6 +1575,7 @@ class GeminiChatApp(QMainWindow):
         # 表示を更新
         self.update_chat()
         self.update_text()
+        return block
     
     def send_text(self):
         if self.is_processing:
@@ -618,35 +1585,85 @@ class GeminiChatApp(QMainWindow):
         if not message:
             return
         
+        self.user_input.clear()
+        self.start_chat(message)
+    
+    def start_chat(self, message):
+        if self.compare_checkbox.isChecked():
+            # 比較用のモデルには、いまの会話が送っている内容(Content)をそのまま渡す（メディアもアップロード済みのものを使う）
+            try:
+                history = list(self.convo.history)
+            except Exception as e: # 前の返答が壊れているなど
+                self.add_error(f"比較の準備に失敗しました: {type(e).__name__} - {e}")
+                return
+        
         self.is_processing = True
         self.set_input_enabled(False) # もろもろを無効化
         
-        self.user_input.clear()
-        self.add_message("[あなた]", message)
+        self.pending_block = self.add_message("[あなた]", message)
         
         # 非同期処理のためスレッドをわける
-        self.current_worker = ChatProcess(self.convo, message)
-        self.current_worker.message_received.connect(self.message_received)
+        if self.compare_checkbox.isChecked():
+            self.current_worker = CompareProcess(self.convo, self.system_instruction, history, message)
+            self.current_worker.compare_received.connect(self.compare_received)
+        else:
+            self.current_worker = ChatProcess(self.convo, message)
+            self.current_worker.message_received.connect(self.message_received)
         self.current_worker.error_occurred.connect(self.add_error)
         self.current_worker.finished.connect(self.processing_finish)
         self.current_worker.start()
     
     def message_received(self, reply):
-        self.add_message("[モデル]", reply)
+        model_block = self.add_message("[モデル]", reply)
+        # 会話履歴を更新
+        self.record_turn({'role': 'user', 'parts': self.current_worker.message}, reply, model_block)
+    
+    def record_turn(self, user_entry, reply, model_block):
+        # 会話ツリーに1往復分を追加する。分岐したときにセッションを作り直せるように、実際に送った内容もセッションの履歴から取っておく
+        try:
+            user_content, model_content = self.convo.history[-2:]
+        except Exception as e: # 返答が壊れていてセッションの履歴が読めない。セッションからも取り消して、会話には残さない
+            self.convo.rewind()
+            self.add_error(f"返答を会話履歴に残せませんでした: {type(e).__name__} - {e}")
+            return
+        user_node = self.tree.append(user_entry, self.pending_block)
+        model_node = self.tree.append({'role': 'model', 'parts': reply}, model_block)
+        user_node.content, model_node.content = user_content, model_content
+    
+    def compare_received(self, results):
+        # モデルごとの返答を表にして横に並べる。会話はいまのモデル（先頭）の返答で続ける
+        headers, cells, plain_parts = [], [], []
+        for result in results:
+            headers.append(f"<th>{bleach.clean(result['label'])}</th>")
+            if "error" in result:
+                body = f"<p class='error'>{bleach.clean(result['error'])}</p>"
+                metrics = "エラー"
+            else:
+                body = render_markdown(result["reply"])
+                metrics = (f"TTFT {result.get('ttft', result['total']):.2f}秒 / 合計 {result['total']:.2f}秒 / "
+                           f"トークン 入力{result['prompt_tokens']}・出力{result['output_tokens']}")
+            cells.append(f"<td><p class='metrics'>{metrics}</p>{body}</td>")
+            plain_parts.append(f"--- {result['label']} ({metrics}) ---\n{result.get('reply', result.get('error', ''))}")
+        table = f"<table class='compare'>\n<tr>{''.join(headers)}</tr>\n<tr>{''.join(cells)}</tr>\n</table>"
+        
+        primary = results[0]
+        model_block = self.add_message("[モデル]", table, "\n\n".join(plain_parts))
+        if "error" in primary: # いまの会話のほうが失敗したら、履歴には残さない
+            self.add_error(primary["error"])
+            return
         # 会話履歴を更新
-        self.history.extend([
-            {'role': 'user', 'parts': self.current_worker.message}, 
-            {'role': 'model', 'parts': reply}
-        ])
+        self.record_turn({'role': 'user', 'parts': self.current_worker.message}, primary["reply"], model_block)
     
     def add_error(self, error_msg):
         self.add_message("[エラー]", error_msg)
     
     def processing_finish(self):
+        self.sessions.touch() # いま通信したので接続は生きている
         self.is_processing = False
         self.set_input_enabled(True) # もろもろを有効化
         self.user_input.setFocus()
     
+    @profiler.section
     def drop_file(self, file_path):
         # ファイルの送信処理
         def is_text_file(file_path, try_bytes=512):
@@ -695,21 +1712,19 @@ class GeminiChatApp(QMainWindow):
         self.user_input.clear()
         
         try:
-            with open(file_path, "rb") as f:
-                file_bytes = f.read()
+            # 読み込みと縮小はバックグラウンドで始めておく
+            media_future = media_pool.submit(load_media, file_path, mime_type)
             
             # ユーザーに表示するファイル情報を整形
             file_info = f"**ファイル**: `{os.path.basename(file_path)}` ({mime_type})"
             if user_message:
                 file_info += f"\n\n**メッセージ**: {user_message}"
             
-            self.add_message("[あなた]", file_info)
-            
-            # ユーザーに表示するファイル情報を整形
-            media_data = {"mime_type": mime_type, "data": file_bytes}
+            self.pending_block = self.add_message("[あなた]", file_info)
             
             # 非同期処理のためスレッドをわける
-            self.current_worker = ChatProcess(self.convo, user_message or "", media_data)
+            self.current_worker = ChatProcess(self.convo, user_message or "", media_future)
+            self.current_worker.media_reported.connect(lambda text: self.add_message("[システム]", text))
             self.current_worker.message_received.connect(
                 lambda reply: self.media_received(reply, file_path, user_message, mime_type)
             )
@@ -722,15 +1737,14 @@ class GeminiChatApp(QMainWindow):
             self.processing_finish()
     
     def media_received(self, reply, file_path, user_message, mime_type):
-        self.add_message("[モデル]", reply)
+        model_block = self.add_message("[モデル]", reply)
         
         # 会話履歴を更新。メディアデータはファイルパスとして保存する。が、これだと復元しても会話できなくなるので、困る。base64にでも変換する？うーん
         parts = [{"mime_type": mime_type, "data": f"{file_path}"}]
         if user_message:
             parts.append(user_message)
         
-        self.history.append({'role': 'user', 'parts': parts})
-        self.history.append({'role': 'model', 'parts': reply})
+        self.record_turn({'role': 'user', 'parts': parts}, reply, model_block)
     
     def send_media(self):
         if self.is_processing:
@@ -750,7 +1764,7 @@ class GeminiChatApp(QMainWindow):
         if self.is_processing:
             return
         
-        if not self.history:
+        if self.tree.is_empty():
             QMessageBox.information(self, "保存", "保存する会話履歴がありません。")
             return
         
@@ -762,20 +1776,110 @@ class GeminiChatApp(QMainWindow):
             return
         
         try:
-            # 保存するデータを辞書にまとめる
+            # 保存するデータを辞書にまとめる。分岐も含めて木ごと保存する（共有している部分は1回だけ書く）
             data = {
                 "modelName": self.model_name,
                 "system_instruction": self.system_instruction,
-                "history": self.history,
-                "chat_markdown": self.chat_markdown
+                "tree": self.tree.to_dict()
             }
             with open(file_path, "w", encoding="utf-8") as f:
                 json.dump(data, f, ensure_ascii=False, indent=4)
             
+            # 描画済みのHTMLをスナップショットとして残しておく（次に読み込んだときに描画し直さなくて済む）
+            fragments = [node.block.html for node in self.tree.nodes()]
+            if any(html is not None for html in fragments):
+                snapshot_pool.submit(save_snapshot, self.render_cache_dir, file_path, fragments)
+            
             self.add_message("[システム]", f"会話履歴を保存しました: `{file_path}`")
         except Exception as e:
             self.add_message("[エラー]", f"保存に失敗しました: {e}")
     
+    def export_chat(self):
+        if self.export_worker is not None: # 書き出し中
+            return
+        
+        file_path, selected_filter = QFileDialog.getSaveFileName(
+            self, "会話をエクスポート", "", "HTMLファイル (*.html);;Markdownファイル (*.md);;PDFファイル (*.pdf)"
+        )
+        if not file_path:
+            return
+        
+        # 拡張子がなければ選んだ形式に合わせる
+        extension = os.path.splitext(file_path)[1].lower()
+        if extension not in (".html", ".md", ".pdf"):
+            match = re.search(r"\*(\.\w+)", selected_filter)
+            extension = match.group(1) if match else ".html" # 形式が分からなければHTMLにする
+            file_path += extension
+        
+        if extension == ".pdf": # PDFは一度HTMLに書き出してから、WebEngineで印刷する
+            fd, html_path = tempfile.mkstemp(suffix=".html")
+            os.close(fd)
+        else:
+            html_path = file_path
+        
+        highlight_theme = "atom-one-dark" if self.is_dark_theme else "atom-one-light"
+        self.export_worker = ExportProcess(
+            self.chat_blocks, html_path, "md" if extension == ".md" else "html",
+            self.get_html_theme_styles(), highlight_theme, self
+        )
+        self.export_worker.finished.connect(self.export_worker.deleteLater)
+        self.export_worker.progress.connect(
+            lambda done, total: self.statusBar().showMessage(f"エクスポート中... {done}/{total}")
+        )
+        if extension == ".pdf":
+            self.export_worker.export_finished.connect(lambda path: self.print_pdf(path, file_path))
+        else:
+            self.export_worker.export_finished.connect(self.export_finish)
+        self.export_worker.error_occurred.connect(lambda msg: self.export_finish(None, msg))
+        if extension == ".pdf": # 失敗したら一時ファイルを消す
+            self.export_worker.error_occurred.connect(lambda msg: os.remove(html_path))
+        self.export_btn.setEnabled(False)
+        self.export_worker.start()
+    
+    def print_pdf(self, html_path, pdf_path):
+        # 書き出したHTMLを表示しないページに読み込み、数式などの描画を待ってからPDFにする
+        self.statusBar().showMessage("PDFを作成中...")
+        self.pdf_page = QWebEnginePage(self)
+        retries = [100] # 描画が終わったか確かめる残り回数（スクリプトが読み込めなかったときは待つのをやめて印刷する）
+        
+        def on_printed(path, success):
+            os.remove(html_path)
+            self.pdf_page.deleteLater()
+            self.pdf_page = None
+            self.export_finish(path if success else None, None if success else "PDFの作成に失敗しました")
+        
+        def on_loaded(ok):
+            if not ok:
+                on_printed(pdf_path, False)
+                return
+            wait_ready()
+        
+        def wait_ready():
+            # EXPORT_TAILのスクリプトが数式とコードの描画を終え、フォントも読み込み終わるまで待つ
+            self.pdf_page.runJavaScript(
+                "window.exportReady === true && document.fonts.status === 'loaded'", on_checked
+            )
+        
+        def on_checked(ready):
+            if ready or retries[0] <= 0:
+                self.pdf_page.printToPdf(pdf_path)
+                return
+            retries[0] -= 1
+            QTimer.singleShot(50, wait_ready)
+        
+        self.pdf_page.pdfPrintingFinished.connect(on_printed)
+        self.pdf_page.loadFinished.connect(on_loaded)
+        self.pdf_page.load(QUrl.fromLocalFile(html_path))
+    
+    def export_finish(self, file_path, error_msg=None):
+        self.export_worker = None
+        self.export_btn.setEnabled(True)
+        self.statusBar().clearMessage()
+        if file_path:
+            self.add_message("[システム]", f"会話をエクスポートしました: `{file_path}`")
+        else:
+            self.add_message("[エラー]", f"エクスポートに失敗しました: {error_msg}")
+    
     def load_chat(self):
         if self.is_processing:
             return
@@ -787,28 +1891,123 @@ class GeminiChatApp(QMainWindow):
         if not file_path:
             return
         
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            
-            # データ復元
-            self.system_instruction = data.get("system_instruction", "")
-            self.history = data.get("history", [])
-            self.chat_markdown = data.get("chat_markdown", "")
-            
-            self.regenerate() # テキスト表示用のログを再生成
-
-            self.sys_inst_entry.setPlainText(self.system_instruction)
-            # 読み込んだ履歴を引き継いでモデルを再初期化
-            self.convo = init_model(self.system_instruction, self.history)
-            
-            # 表示を更新
-            self.update_chat()
-            self.update_text()
-            
-            self.add_message("[システム]", f"会話履歴を読み込みました: `{file_path}`")
-        except Exception as e:
-            self.add_message("[エラー]", f"読み込みに失敗しました: {e}")
+        # 解析はバックグラウンドで行い、終わるまでは送信などをできないようにする
+        self.is_processing = True
+        self.set_input_enabled(False)
+        self.statusBar().showMessage("読み込み中...")
+        self.load_worker = LoadProcess(file_path, self.render_cache_dir)
+        self.load_worker.progress.connect(lambda percent: self.statusBar().showMessage(f"読み込み中... {percent}%"))
+        self.load_worker.loaded.connect(lambda *loaded: self.chat_loaded(file_path, *loaded))
+        self.load_worker.error_occurred.connect(lambda msg: self.add_message("[エラー]", f"読み込みに失敗しました: {msg}"))
+        self.load_worker.finished.connect(self.load_finish)
+        self.load_worker.start()
+    
+    def chat_loaded(self, file_path, tree, convo, system_instruction, text, content_hash, snapshot_hit):
+        self.stop_progressive()
+        # データ復元
+        self.system_instruction = system_instruction
+        self.tree = tree
+        self.sys_inst_entry.setPlainText(self.system_instruction)
+        self.convo = convo
+        self.sessions.model = convo.model # 入力中はこのモデルで接続を温める
+        
+        # 新しいメッセージだけをすぐに表示して、古いものはバックグラウンドで描画できたものから上に足していく
+        self.chat_blocks = [ChatBlock("[システム]", "Geminiチャットへようこそ。")]
+        self.chat_blocks.extend(n.block for n in self.tree.path())
+        self.hidden_blocks = max(0, len(self.chat_blocks) - RECENT_BLOCKS)
+        self.chat_text_content = text
+        if not snapshot_hit: # 描画が終わったらスナップショットを作り直す（会話が進んでもいいように、いまのノードを覚えておく）
+            nodes = list(self.tree.nodes())
+            self.pending_snapshot = (content_hash, nodes, sum(node.block.html is None for node in nodes))
+        self.add_message("[システム]", f"会話履歴を読み込みました: `{file_path}`")
+        
+        if not self.hidden_blocks:
+            self.store_snapshot()
+        else:
+            self.statusBar().showMessage("古いメッセージを表示しています...")
+            self.render_worker = RenderProcess(self.chat_blocks[:self.hidden_blocks], self)
+            self.render_worker.batch_rendered.connect(self.older_rendered)
+            self.render_worker.finished.connect(self.render_worker.deleteLater)
+            self.render_worker.start()
+    
+    def load_finish(self):
+        self.load_worker = None
+        if self.render_worker is None:
+            self.statusBar().clearMessage()
+        self.is_processing = False
+        self.set_input_enabled(True)
+        self.user_input.setFocus()
+    
+    @profiler.section
+    def show_branch(self, node, notice):
+        # nodeまでの分岐を表示する。モデルはそこまでの履歴で作り直す（描画済みのメッセージはキャッシュを使う）
+        self.stop_progressive()
+        self.tree.current = node
+        self.convo = self.sessions.create(self.system_instruction, self.tree.session_history())
+        self.chat_blocks = [ChatBlock("[システム]", "Geminiチャットへようこそ。")]
+        self.chat_blocks.extend(n.block for n in self.tree.path())
+        self.regenerate() # テキスト表示用のログを再生成
+        self.add_message("[システム]", notice)
+    
+    def edit_message(self):
+        # 過去のメッセージを編集して送り直す。編集したメッセージより前の履歴を共有した新しい分岐になる
+        if self.is_processing:
+            return
+        
+        user_nodes = [n for n in self.tree.path() if n.entry['role'] == 'user']
+        if not user_nodes:
+            QMessageBox.information(self, "編集", "編集できるメッセージがありません。")
+            return
+        
+        items = [f"{i + 1}: {n.block.text[:40]}".replace("\n", " ") for i, n in enumerate(user_nodes)]
+        item, ok = QInputDialog.getItem(self, "メッセージの編集", "編集するメッセージを選んでください:", items, len(items) - 1, False)
+        if not ok:
+            return
+        node = user_nodes[items.index(item)]
+        
+        if isinstance(node.entry['parts'], list): # メディア自体は保存していないので送り直せない
+            self.add_message("[システム]", "メディアを添付したメッセージは編集できません。")
+            return
+        
+        text, ok = QInputDialog.getMultiLineText(
+            self, "メッセージの編集", "新しいメッセージ（変更せずにOKを押すと返答を再生成します）:", node.entry['parts']
+        )
+        if not ok or not text.strip():
+            return
+        
+        if not self.tree.can_restore(node.parent):
+            self.add_message("[システム]", "このメッセージより前に、読み込んだ会話のメディアがあるため分岐できません。")
+            return
+        
+        self.show_branch(node.parent, f"{items.index(item) + 1}番目のメッセージから新しい分岐を作りました。")
+        self.start_chat(text.strip())
+    
+    def switch_branch(self):
+        if self.is_processing:
+            return
+        
+        leaves = self.tree.leaves()
+        if len(leaves) < 2:
+            QMessageBox.information(self, "分岐切替", "切り替えられる分岐がありません。")
+            return
+        
+        items = []
+        for i, leaf in enumerate(leaves):
+            path = self.tree.path(leaf)
+            last_user = next((n for n in reversed(path) if n.entry['role'] == 'user'), None)
+            mark = "＊" if leaf is self.tree.current else ""
+            preview = last_user.block.text[:40].replace("\n", " ") if last_user else ""
+            items.append(f"{mark}分岐{i + 1} ({len(path)}件): {preview}")
+        current = next((i for i, item in enumerate(items) if item.startswith("＊")), 0)
+        item, ok = QInputDialog.getItem(self, "分岐切替", "表示する分岐を選んでください:", items, current, False)
+        if not ok:
+            return
+        
+        leaf = leaves[items.index(item)]
+        if not self.tree.can_restore(leaf):
+            self.add_message("[システム]", "この分岐には読み込んだ会話のメディアがあるため、切り替えられません。")
+            return
+        self.show_branch(leaf, f"分岐{items.index(item) + 1}に切り替えました。")
     
     def reset_chat(self):
         if self.is_processing:
@@ -821,25 +2020,33 @@ class GeminiChatApp(QMainWindow):
         )
         if reply == QMessageBox.Yes:
             # もろもろを初期化
-            self.convo = init_model(self.system_instruction)
-            self.history.clear()
-            self.chat_markdown = ""
+            self.stop_progressive()
+            self.convo = self.sessions.create(self.system_instruction)
+            self.tree = ConversationTree()
+            self.chat_blocks = []
             self.chat_text_content = ""
             self.add_message("[システム]", "会話をリセットしました。")
             self.user_input.setFocus()
 
 
 def main():
+    if args.benchmark: # 計測だけして終わる
+        run_benchmark(args.benchmark)
+        return
+
     app = QApplication(sys.argv)
     
     app.setApplicationName("Gemini Chat")
     app.setApplicationVersion("2.0")
     app.setOrganizationName("Gemini Chat App")
     
+    if args.watchdog: # GUIが止まっていないかを見張る
+        watchdog = StallWatchdog(args.watchdog)
+    
     window = GeminiChatApp()
     window.show()
     
     sys.exit(app.exec_())
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
\ No newline at end of file